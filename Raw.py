@@ -1,139 +1,235 @@
-import os, re, json
-import pandas as pd
-import fitz                        # PyMuPDF
+import os, csv, json, time, hashlib, tempfile
+import diskcache
 from dotenv import load_dotenv
-import openai
+from openai import OpenAI, NotFoundError
+from utils import read_pdfs_cached, all_values_found, load_master_data, index_by_patient_id
+from prompts import MODEL, RESPONSE_FORMAT, cache_key, split_cached, build_messages, max_output_tokens, response_text, parse_verdicts
 
 # — Load API Key —
 load_dotenv()
-openai.api_key = os.getenv("OPENAI_API_KEY")
 
 # — Config —
 EXCEL_FILE   = "Master data.xlsx"
 PDF_FOLDER   = "pdfs"
 OUTPUT_FILE  = "discrepancy_report.csv"
+BATCH_FILE   = "batch.jsonl"       # Batch API request file, written to a temp dir
+POLL_MIN     = 10                  # seconds between batch status checks,
+POLL_MAX     = 300                 # doubling from POLL_MIN up to POLL_MAX
+CACHE_DIR    = ".gpt_cache"        # GPT responses, shared with app.py
+PDF_CACHE    = ".pdf_cache"        # extracted PDF text, shared with app.py
+BATCH_SIZE   = 8                   # PDFs compared per GPT request
+MAX_RETRIES  = 5                   # SDK retries on 408/409/429/5xx and connection errors
+
+cache = diskcache.Cache(CACHE_DIR)
+pdf_cache = diskcache.Cache(PDF_CACHE)
 
 # — Helpers —
 
-def extract_text_from_pdf(path):
-    doc = fitz.open(path)
-    return "\n".join(p.get_text() for p in doc)
-
-def find_patient_id(text):
-    m = re.search(r"(?:Patient\s*ID|ID)\s*[:\-]?\s*(\d+)", text, re.IGNORECASE)
-    return m.group(1) if m else None
-
-def compare_with_gpt(pdf_text, excel_row):
-    system = """
-You are a data verification assistant. Your ONLY job is to find ACTUAL DATA ERRORS.
-
-STRICT RULES:
-
-1. IGNORE these situations (DO NOT REPORT):
-   - Fields not found in PDF
-   - Date format differences (2024-12-01 00:00:00 = 1-Dec-2024 = 12/01/2024)
-   - Text format differences (BCBS = EXCEL BCBS = Finance Class BCBS)
-   - Case differences (JOHN = John = john)
-   - Extra spaces or punctuation
-   - Different field labels
-
-2. ONLY REPORT these situations:
-   - Completely different names (John Smith ≠ Jane Doe)
-   - Different insurance companies (BCBS ≠ Aetna) 
-   - Different calendar dates (Jan 1 ≠ Dec 31)
-   - Different amounts ($100 ≠ $200)
-
-EXAMPLES OF WHAT NOT TO REPORT:
-❌ "SWO Expiration Date: Excel has '2024-12-01 00:00:00', PDF has '1-Dec-2024'" = SAME DATE
-❌ "Field 'Last usage Date' not found in PDF" = IRRELEVANT
-❌ "Insurance: Excel has 'BCBS', PDF has 'Finance Class BCBS'" = SAME COMPANY
-
-EXAMPLES OF WHAT TO REPORT:
-✅ "Patient Name: Excel has 'JOHN SMITH', PDF has 'JANE DOE'" = DIFFERENT PERSON
-✅ "Insurance: Excel has 'BCBS', PDF has 'AETNA'" = DIFFERENT COMPANY
-
-RESPONSE FORMAT:
-- If no actual data errors exist: "No discrepancies"
-- If actual data errors found: "Field Name: Excel has 'X', PDF has 'Y'"
-
-Be very strict - only report genuine data errors, not formatting or missing field issues.
-"""
-
-    user = (
-        "PDF Text:\n```\n"
-        + pdf_text[:3800]
-        + "\n```\n\nExcel Data:\n```json\n"
-        + json.dumps(excel_row, indent=2, default=str)
-        + "\n```"
+# Chat messages for a group of (fname, txt, excel_row) cases; cases are numbered
+# within the group, since GPT would have to echo file names back exactly
+def group_messages(cases):
+    return build_messages([(j, txt, excel_row) for j, (_, txt, excel_row) in enumerate(cases)])
+
+# Write one chat completion request per group of cases to JSONL and start a batch;
+# the file lives in a temporary directory that is removed once it is uploaded
+def submit_batch(client, groups):
+    with tempfile.TemporaryDirectory(prefix="batch_") as temp_dir:
+        batch_path = os.path.join(temp_dir, BATCH_FILE)
+        with open(batch_path, "w", encoding="utf-8") as f:
+            for i, cases in enumerate(groups):
+                f.write(json.dumps({
+                    "custom_id": f"group-{i}",
+                    "method": "POST",
+                    "url": "/v1/chat/completions",
+                    "body": {
+                        "model": MODEL,
+                        "temperature": 0.0,
+                        "max_tokens": max_output_tokens(cases),
+                        "response_format": RESPONSE_FORMAT,
+                        "messages": group_messages(cases),
+                    },
+                }) + "\n")
+
+        with open(batch_path, "rb") as f:
+            batch_input = client.files.create(file=f, purpose="batch")
+
+    return client.batches.create(
+        input_file_id=batch_input.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h",
     )
 
-    resp = openai.ChatCompletion.create(
-        model="gpt-4",
-        temperature=0.0,
-        messages=[
-            {"role": "system",  "content": system},
-            {"role": "user",    "content": user}
-        ]
-    )
-    return resp.choices[0].message.content.strip()
+# Key under which the id of a submitted batch is kept until its results are in,
+# so a re-run after an interruption resumes it instead of paying for it twice
+def batch_cache_key(groups):
+    payload = json.dumps([group_messages(cases) for cases in groups], ensure_ascii=False)
+    return "batch:" + hashlib.sha256(payload.encode()).hexdigest()
+
+# Poll the batch with exponential backoff; return {custom_id: response text}
+def wait_for_batch(client, batch_id):
+    delay = POLL_MIN
+    while True:
+        batch = client.batches.retrieve(batch_id)
+        if batch.status == "completed":
+            break
+        if batch.status in ("failed", "expired", "cancelled"):
+            raise RuntimeError(f"Batch {batch_id} ended with status '{batch.status}'")
+        print(f"[⏳] Batch {batch_id}: {batch.status}, checking again in {delay}s")
+        time.sleep(delay)
+        delay = min(delay * 2, POLL_MAX)
+
+    results = {}
+    for file_id in (batch.output_file_id, batch.error_file_id):
+        if not file_id:
+            continue
+        for line in client.files.content(file_id).text.splitlines():
+            item = json.loads(line)
+            response = item.get("response") or {}
+            if response.get("status_code") == 200:
+                choice = response["body"]["choices"][0]
+                message = choice["message"]
+                try:
+                    content = response_text(message.get("content"), message.get("refusal"), choice.get("finish_reason"))
+                    results[item["custom_id"]] = content.strip()
+                except ValueError as e:
+                    results[item["custom_id"]] = f"Error during comparison: {e}"
+            else:
+                error = item.get("error") or response.get("body", {}).get("error")
+                results[item["custom_id"]] = f"Error during comparison: {error}"
+    return results
 
 # — Main —
 
-df = pd.read_excel(EXCEL_FILE, dtype={"Patient ID": str})
-reports = []
-
-print(f"📋 Loaded {len(df)} records from Excel")
-
-for fname in os.listdir(PDF_FOLDER):
-    if not fname.lower().endswith(".pdf"):
-        continue
-
-    path = os.path.join(PDF_FOLDER, fname)
-    txt  = extract_text_from_pdf(path)
-
-    pid = find_patient_id(txt)
-    if not pid:
-        print(f"[❌] {fname}: No Patient ID found")
-        continue
-
-    matching_records = df[df["Patient ID"] == pid]
-    if matching_records.empty:
-        print(f"[⚠️] {fname}: Patient ID {pid} not in Excel")
-        continue
-    
-    excel_row = matching_records.iloc[0].to_dict()
-    
-    print(f"[🔍] {fname} - Patient ID {pid}: Checking for data errors...")
-    
-    discrepancies = compare_with_gpt(txt, excel_row)
-
-    # Clean up the response
-    if "no discrepancies" in discrepancies.lower() or "all the data" in discrepancies.lower():
-        clean_discrepancies = "No discrepancies"
-    else:
-        clean_discrepancies = discrepancies
-
-    reports.append({
-        "Patient ID": pid,
-        "PDF File": fname,
-        "Data Errors": clean_discrepancies
-    })
-
-# Save results
-result_df = pd.DataFrame(reports)
-result_df.to_csv(OUTPUT_FILE, index=False)
-
-# Summary
-actual_errors = len(result_df[~result_df["Data Errors"].str.contains("No discrepancies", na=False)])
-no_errors = len(reports) - actual_errors
-
-print(f"\n✅ Report saved to {OUTPUT_FILE}")
-print(f"📊 Summary:")
-print(f"   - Files with NO data errors: {no_errors}")
-print(f"   - Files with ACTUAL data errors: {actual_errors}")
-
-if actual_errors > 0:
-    print(f"\n🚨 Files with data errors:")
-    error_files = result_df[~result_df["Data Errors"].str.contains("No discrepancies", na=False)]
-    for _, row in error_files.iterrows():
-        print(f"   - {row['PDF File']} (ID: {row['Patient ID']}): {row['Data Errors']}")
+def main():
+    df = load_master_data(EXCEL_FILE)
+    excel_by_pid = index_by_patient_id(df)
+    rows = []
+
+    print(f"📋 Loaded {len(df)} records from Excel")
+
+    # Extract text and Patient IDs in parallel, skipping PDFs extracted in earlier runs
+    with os.scandir(PDF_FOLDER) as it:
+        entries = [e for e in it if e.name.lower().endswith(".pdf") and e.is_file()]
+    fnames = [e.name for e in entries]
+    extracted = read_pdfs_cached([e.path for e in entries], pdf_cache)
+
+    for fname, result in zip(fnames, extracted):
+        if isinstance(result, Exception):
+            print(f"[❌] {fname}: Could not read PDF ({result})")
+            continue
+
+        txt, pid = result
+        if not pid:
+            print(f"[❌] {fname}: No Patient ID found")
+            continue
+
+        excel_row = excel_by_pid.get(pid)
+        if excel_row is None:
+            print(f"[⚠️] {fname}: Patient ID {pid} not in Excel")
+            continue
+
+        print(f"[🔍] {fname} - Patient ID {pid}: Checking for data errors...")
+        rows.append((fname, pid, txt, excel_row))
+
+    pids = {fname: pid for fname, pid, _, _ in rows}
+    error_details = []
+    comparison_errors = []
+
+    # Stream report rows to CSV as soon as each verdict is known, so a crash
+    # while waiting on the batch keeps everything settled so far
+    with open(OUTPUT_FILE, "w", newline="", encoding="utf-8") as csv_f:
+        writer = csv.DictWriter(csv_f, fieldnames=["Patient ID", "PDF File", "Data Errors"])
+        writer.writeheader()
+
+        def report(fname, verdict):
+            writer.writerow({"Patient ID": pids[fname], "PDF File": fname, "Data Errors": verdict})
+            csv_f.flush()
+            if verdict.startswith("Error during comparison"):
+                comparison_errors.append((fname, pids[fname], verdict))
+            elif verdict != "No discrepancies":
+                error_details.append((fname, pids[fname], verdict))
+
+        # Settle exact matches locally and reuse cached answers; compare the
+        # rest with GPT in a single batch, BATCH_SIZE PDFs per request
+        to_compare = []
+        for fname, _, txt, excel_row in rows:
+            if all_values_found(txt, excel_row):
+                report(fname, "No discrepancies")
+            else:
+                to_compare.append((fname, txt, excel_row))
+        # Identical cases (e.g. the same PDF under two names) are sent once
+        cached, uncached, copies = split_cached(to_compare, cache)
+        for fname, verdict in cached.items():
+            report(fname, verdict)
+
+        n_copies = sum(len(names) for names in copies.values())
+        print(f"[💾] {len(rows) - len(uncached) - n_copies} of {len(rows)} comparisons settled without GPT")
+        if n_copies:
+            print(f"[♻️] {n_copies} duplicate PDFs will reuse another file's verdict")
+
+        if uncached:
+            groups = [uncached[i:i + BATCH_SIZE] for i in range(0, len(uncached), BATCH_SIZE)]
+            client = OpenAI(max_retries=MAX_RETRIES)
+            batch_key = batch_cache_key(groups)
+            batch_id = cache.get(batch_key)
+            if batch_id is None:
+                batch_id = submit_batch(client, groups).id
+                cache[batch_key] = batch_id
+                print(f"[📤] Submitted batch {batch_id} with {len(groups)} requests for {len(uncached)} PDFs")
+            else:
+                print(f"[🔁] Resuming batch {batch_id} submitted by an earlier run")
+            try:
+                batch_results = wait_for_batch(client, batch_id)
+            except (RuntimeError, NotFoundError):
+                # Failed, expired, or unknown to this API key/project (e.g. after
+                # switching keys): submit a fresh batch next time
+                cache.delete(batch_key)
+                raise
+
+            for i, cases in enumerate(groups):
+                content = batch_results.get(f"group-{i}", "Error during comparison: no response in batch output")
+                if content.startswith("Error during comparison"):
+                    verdicts, error = {}, content
+                else:
+                    try:
+                        verdicts = parse_verdicts(content)
+                        error = "Error during comparison: no verdict returned"
+                    except (ValueError, KeyError, TypeError) as e:
+                        verdicts = {}
+                        error = f"Error during comparison: unreadable response ({e})"
+
+                for j, (fname, txt, excel_row) in enumerate(cases):
+                    verdict = verdicts.get(str(j))
+                    if verdict is None:
+                        verdict = error
+                    else:
+                        cache[cache_key(txt, excel_row)] = verdict
+                    for name in [fname, *copies.get(fname, ())]:
+                        report(name, verdict)
+
+            # Verdicts are cached now; a re-run retries only the failed cases in a new batch
+            cache.delete(batch_key)
+
+    # Summary
+    actual_errors = len(error_details)
+    failed = len(comparison_errors)
+    no_errors = len(rows) - actual_errors - failed
+
+    print(f"\n✅ Report saved to {OUTPUT_FILE}")
+    print(f"📊 Summary:")
+    print(f"   - Files with NO data errors: {no_errors}")
+    print(f"   - Files with ACTUAL data errors: {actual_errors}")
+    print(f"   - Files that could not be compared: {failed}")
+
+    if actual_errors > 0:
+        print(f"\n🚨 Files with data errors:")
+        for fname, pid, verdict in error_details:
+            print(f"   - {fname} (ID: {pid}): {verdict}")
+
+    if failed > 0:
+        print("\n❌ Files that could not be compared (re-run to retry):")
+        for fname, pid, verdict in comparison_errors:
+            print(f"   - {fname} (ID: {pid}): {verdict}")
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,18 @@
 import streamlit as st
 import os
-import re
-import json
+import time
+import asyncio
+import diskcache
 import pandas as pd
-import fitz  # PyMuPDF
-import openai
+from openai import (
+    AsyncOpenAI, OpenAI, RateLimitError, APITimeoutError, APIConnectionError, InternalServerError
+)
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_random_exponential
 from datetime import datetime
-import tempfile
-import zipfile
 from io import BytesIO
 from dotenv import load_dotenv
+from utils import read_pdfs_cached, all_values_found, load_master_data, index_by_patient_id
+from prompts import MODEL, RESPONSE_FORMAT, cache_key, split_cached, build_messages, max_output_tokens, response_text, parse_verdicts
 
 # Load environment variables
 load_dotenv()
@@ -60,87 +63,147 @@ st.markdown("""
 """, unsafe_allow_html=True)
 
 # Initialize OpenAI API key
-openai.api_key = os.getenv("OPENAI_API_KEY")
-
-# Helper functions
-def extract_text_from_pdf(file_bytes):
-    """Extract text from PDF bytes"""
-    doc = fitz.open(stream=file_bytes, filetype="pdf")
-    text = "\n".join(page.get_text() for page in doc)
-    doc.close()
-    return text
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 
-def find_patient_id(text):
-    """Extract Patient ID from PDF text"""
-    m = re.search(r"(?:Patient\s*ID|ID)\s*[:\-]?\s*(\d+)", text, re.IGNORECASE)
-    return m.group(1) if m else None
-
-def compare_with_gpt(pdf_text, excel_row):
-    """Compare PDF text with Excel data using GPT"""
-    system = """
-You are a data verification assistant. Your ONLY job is to find ACTUAL DATA ERRORS.
+def env_limit(name, default):
+    """Read a positive whole number from the environment, falling back to default"""
+    value = os.getenv(name)
+    if value is None or not value.strip():
+        return default
+    try:
+        limit = int(value)
+    except ValueError:
+        st.error(f"❌ {name} must be a whole number, got '{value}'. Using the default of {default}.")
+        return default
+    if limit < 1:
+        st.warning(f"⚠️ {name} must be at least 1, got {limit}. Using 1.")
+        return 1
+    return limit
 
-STRICT RULES:
+# Requests started per minute; keep at or below the account's RPM limit
+MAX_REQUESTS_PER_MINUTE = env_limit("OPENAI_RPM_LIMIT", 500)
 
-1. IGNORE these situations (DO NOT REPORT):
-   - Fields not found in PDF
-   - Date format differences (2024-12-01 00:00:00 = 1-Dec-2024 = 12/01/2024)
-   - Text format differences (BCBS = EXCEL BCBS = Finance Class BCBS)
-   - Case differences (JOHN = John = john)
-   - Extra spaces or punctuation
-   - Different field labels
+# Maximum number of GPT requests in flight at once
+MAX_CONCURRENCY = env_limit("OPENAI_MAX_CONCURRENCY", 32)
 
-2. ONLY REPORT these situations:
-   - Completely different names (John Smith ≠ Jane Doe)
-   - Different insurance companies (BCBS ≠ Aetna) 
-   - Different calendar dates (Jan 1 ≠ Dec 31)
-   - Different amounts ($100 ≠ $200)
+# Transient failures worth retrying; bad requests and auth errors fail at once
+TRANSIENT_ERRORS = (RateLimitError, APITimeoutError, APIConnectionError, InternalServerError)
 
-EXAMPLES OF WHAT NOT TO REPORT:
-❌ "SWO Expiration Date: Excel has '2024-12-01 00:00:00', PDF has '1-Dec-2024'" = SAME DATE
-❌ "Field 'Last usage Date' not found in PDF" = IRRELEVANT
-❌ "Insurance: Excel has 'BCBS', PDF has 'Finance Class BCBS'" = SAME COMPANY
+# PDFs compared per GPT request
+BATCH_SIZE = 8
 
-EXAMPLES OF WHAT TO REPORT:
-✅ "Patient Name: Excel has 'JOHN SMITH', PDF has 'JANE DOE'" = DIFFERENT PERSON
-✅ "Insurance: Excel has 'BCBS', PDF has 'AETNA'" = DIFFERENT COMPANY
+# Persistent GPT response cache; lives outside session state so it survives reruns
+cache = diskcache.Cache(".gpt_cache")
 
-RESPONSE FORMAT:
-- If no actual data errors exist: "No discrepancies"
-- If actual data errors found: "Field Name: Excel has 'X', PDF has 'Y'"
+# Persistent PDF extraction cache keyed by file content; shared with Raw.py
+pdf_cache = diskcache.Cache(".pdf_cache")
 
-Be very strict - only report genuine data errors, not formatting or missing field issues.
-"""
+# Helper functions
+class RateLimiter:
+    """Spaces request starts evenly so they stay under a requests-per-minute limit"""
+    
+    def __init__(self, per_minute):
+        self.interval = 60.0 / per_minute
+        self.next_start = time.monotonic()
+        self.lock = asyncio.Lock()
+    
+    async def wait(self):
+        async with self.lock:
+            now = time.monotonic()
+            delay = self.next_start - now
+            self.next_start = max(now, self.next_start) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
 
-    user = (
-        "PDF Text:\n```\n"
-        + pdf_text[:3800]
-        + "\n```\n\nExcel Data:\n```json\n"
-        + json.dumps(excel_row, indent=2, default=str)
-        + "\n```"
+@retry(
+    retry=retry_if_exception_type(TRANSIENT_ERRORS),
+    wait=wait_random_exponential(min=1, max=30),
+    stop=stop_after_attempt(6),
+    reraise=True
+)
+async def create_completion(client, limiter, cases):
+    """Send a chat completion request, retrying transient errors with jittered backoff"""
+    await limiter.wait()
+    return await client.chat.completions.create(
+        model=MODEL,
+        temperature=0.0,
+        max_tokens=max_output_tokens(cases),
+        response_format=RESPONSE_FORMAT,
+        messages=build_messages(cases)
     )
 
+async def compare_with_gpt(client, limiter, cases, sem):
+    """Compare a batch of PDF texts with their Excel rows in one GPT request"""
     try:
-        resp = openai.ChatCompletion.create(
-            model="gpt-4",
-            temperature=0.0,
-            messages=[
-                {"role": "system", "content": system},
-                {"role": "user", "content": user}
-            ]
-        )
-        return resp.choices[0].message.content.strip()
+        async with sem:
+            resp = await create_completion(client, limiter, cases)
+        choice = resp.choices[0]
+        verdicts = parse_verdicts(response_text(choice.message.content, choice.message.refusal, choice.finish_reason))
+        error = "Error during comparison: no verdict returned"
     except Exception as e:
-        return f"Error during comparison: {str(e)}"
+        verdicts = {}
+        error = f"Error during comparison: {str(e)}"
+    
+    results = {}
+    for case_id, pdf_text, excel_row in cases:
+        verdict = verdicts.get(str(case_id))
+        if verdict is None:
+            results[case_id] = error
+        else:
+            cache[cache_key(pdf_text, excel_row)] = verdict
+            results[case_id] = verdict
+    return results
+
+async def compare_all(pending, on_complete):
+    """Compare all cases, BATCH_SIZE per request and up to MAX_CONCURRENCY requests at once"""
+    # Identical cases (e.g. the same PDF uploaded twice) are sent once
+    results, misses, copies = split_cached(pending, cache)
+    if not misses:
+        return results
+    
+    # Retries are handled by create_completion, not the SDK
+    client = AsyncOpenAI(api_key=OPENAI_API_KEY, max_retries=0)
+    limiter = RateLimiter(MAX_REQUESTS_PER_MINUTE)
+    sem = asyncio.Semaphore(MAX_CONCURRENCY)
+    batches = [misses[i:i + BATCH_SIZE] for i in range(0, len(misses), BATCH_SIZE)]
+    try:
+        for task in asyncio.as_completed([compare_with_gpt(client, limiter, cases, sem) for cases in batches]):
+            answers = await task
+            for case_id, answer in answers.items():
+                for copy_id in copies.get(case_id, ()):
+                    results[copy_id] = answer
+            results.update(answers)
+            on_complete(len(results), len(pending))
+    finally:
+        await client.close()
+    return results
+
+@st.cache_data(show_spinner=False)
+def load_excel(file_bytes):
+    """Parse uploaded Excel bytes; reruns with the same file hit the cache"""
+    return load_master_data(BytesIO(file_bytes))
+
+@st.cache_resource
+def get_client():
+    """OpenAI client shared by all reruns and sessions, keeping its connection pool warm"""
+    return OpenAI(api_key=OPENAI_API_KEY)
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def verify_api_key():
+    """Test the API key with a simple request, at most once an hour.
+
+    Failures raise, and exceptions are not cached, so a bad key is
+    re-checked on the next rerun.
+    """
+    get_client().models.list()
 
 def check_api_key():
     """Check if OpenAI API key is available and valid"""
-    if not openai.api_key:
+    if not OPENAI_API_KEY:
         return False, "OpenAI API key not found in .env file"
     
     try:
-        # Test API key with a simple request
-        openai.Model.list()
+        verify_api_key()
         return True, "API key is valid"
     except Exception as e:
         return False, f"API key error: {str(e)}"
@@ -149,77 +212,91 @@ def process_files(pdf_files, excel_file):
     """Process all PDF files and return results"""
     # Load Excel data
     try:
-        df = pd.read_excel(excel_file, dtype={"Patient ID": str})
+        df = load_excel(excel_file.getvalue())
     except Exception as e:
         st.error(f"Error reading Excel file: {str(e)}")
         return None
     
-    reports = []
+    if "Patient ID" not in df.columns:
+        st.error("Error reading Excel file: no 'Patient ID' column found")
+        return None
+    
+    excel_by_pid = index_by_patient_id(df)
+    
+    # Report columns, filled row by row and turned into a DataFrame once at the end
+    reports = {"Patient ID": [], "PDF File": [], "Data Errors": [], "Status": []}
+    pending = []
+    
+    def report(pid, fname, errors, status):
+        reports["Patient ID"].append(pid)
+        reports["PDF File"].append(fname)
+        reports["Data Errors"].append(errors)
+        reports["Status"].append(status)
+    
     progress_bar = st.progress(0)
     status_text = st.empty()
     
-    for i, pdf_file in enumerate(pdf_files):
+    def on_read(done, total):
+        progress_bar.progress(done / total)
+        status_text.text(f"Reading PDFs ({done}/{total})")
+    
+    # Extract text and Patient IDs in parallel; files seen before come from the cache.
+    # getbuffer() is a view of the upload, so cached files are hashed without a copy
+    status_text.text(f"Reading {len(pdf_files)} PDFs...")
+    extracted = read_pdfs_cached([pdf_file.getbuffer() for pdf_file in pdf_files], pdf_cache, on_read)
+    
+    for pdf_file, result in zip(pdf_files, extracted):
         try:
-            # Update progress
-            progress = (i + 1) / len(pdf_files)
-            progress_bar.progress(progress)
-            status_text.text(f"Processing {pdf_file.name} ({i+1}/{len(pdf_files)})")
-            
-            # Extract text from PDF
-            pdf_bytes = pdf_file.getvalue()
-            txt = extract_text_from_pdf(pdf_bytes)
+            if isinstance(result, Exception):
+                raise result
             
-            # Find Patient ID
-            pid = find_patient_id(txt)
+            txt, pid = result
             if not pid:
-                reports.append({
-                    "Patient ID": "Not Found",
-                    "PDF File": pdf_file.name,
-                    "Data Errors": "Patient ID not found in PDF",
-                    "Status": "Error"
-                })
+                report("Not Found", pdf_file.name, "Patient ID not found in PDF", "Error")
                 continue
             
             # Find matching record in Excel
-            matching_records = df[df["Patient ID"] == pid]
-            if matching_records.empty:
-                reports.append({
-                    "Patient ID": pid,
-                    "PDF File": pdf_file.name,
-                    "Data Errors": f"Patient ID {pid} not found in Excel master data",
-                    "Status": "Error"
-                })
+            excel_row = excel_by_pid.get(pid)
+            if excel_row is None:
+                report(pid, pdf_file.name, f"Patient ID {pid} not found in Excel master data", "Error")
                 continue
             
-            # Compare with GPT
-            excel_row = matching_records.iloc[0].to_dict()
-            discrepancies = compare_with_gpt(txt, excel_row)
+            # Every Excel value found verbatim in the PDF: no need to ask GPT
+            if all_values_found(txt, excel_row):
+                report(pid, pdf_file.name, "No discrepancies", "Clean")
+                continue
             
-            # Clean up response
-            if "no discrepancies" in discrepancies.lower() or "all the data" in discrepancies.lower():
-                clean_discrepancies = "No discrepancies"
+            # Queue the whole row for GPT; the slot is filled in once the response arrives
+            pending.append((len(reports["PDF File"]), txt, excel_row))
+            report(pid, pdf_file.name, None, None)
+            
+        except Exception as e:
+            report("Error", pdf_file.name, f"Processing error: {str(e)}", "Error")
+    
+    # Compare with GPT, all files concurrently
+    if pending:
+        progress_bar.progress(0)
+        
+        def on_complete(done, total):
+            progress_bar.progress(done / total)
+            status_text.text(f"Comparing with GPT ({done}/{total})")
+        
+        try:
+            results = asyncio.run(compare_all(pending, on_complete))
+        except Exception as e:
+            # Report the failure on each waiting file instead of losing every result
+            results = {key: f"Error during comparison: {str(e)}" for key, _, _ in pending}
+        
+        for key, discrepancies in results.items():
+            if discrepancies == "No discrepancies":
                 status = "Clean"
-            elif "Error during comparison" in discrepancies:
-                clean_discrepancies = discrepancies
+            elif discrepancies.startswith("Error during comparison"):
                 status = "Error"
             else:
-                clean_discrepancies = discrepancies
                 status = "Data Error"
             
-            reports.append({
-                "Patient ID": pid,
-                "PDF File": pdf_file.name,
-                "Data Errors": clean_discrepancies,
-                "Status": status
-            })
-            
-        except Exception as e:
-            reports.append({
-                "Patient ID": "Error",
-                "PDF File": pdf_file.name,
-                "Data Errors": f"Processing error: {str(e)}",
-                "Status": "Error"
-            })
+            reports["Data Errors"][key] = discrepancies
+            reports["Status"][key] = status
     
     # Clear progress indicators
     progress_bar.empty()
@@ -329,7 +406,7 @@ def main():
             
             # Preview Excel data
             try:
-                df_preview = pd.read_excel(excel_file, dtype={"Patient ID": str})
+                df_preview = load_excel(excel_file.getvalue())
                 st.info(f"📊 Excel contains {len(df_preview)} records with {len(df_preview.columns)} fields")
                 
                 with st.expander("Preview Excel Data"):
@@ -362,6 +439,9 @@ def main():
                 if results_df is not None:
                     # Store results in session state
                     st.session_state.results_df = results_df
+                    # Build the report files once here, not on every rerun of the dashboard
+                    st.session_state.report_csv = results_df.to_csv(index=False)
+                    st.session_state.errors_csv = results_df[results_df["Status"].ne("Clean")].to_csv(index=False)
                     st.session_state.processing_complete = True
                     
                     st.success("✅ Processing completed!")
@@ -375,22 +455,27 @@ def main():
         # Summary metrics
         col1, col2, col3, col4 = st.columns(4)
         
+        # Count every status in one pass
+        status_counts = results_df["Status"].value_counts()
         total_files = len(results_df)
-        clean_files = len(results_df[results_df["Status"] == "Clean"])
-        error_files = len(results_df[results_df["Status"] == "Data Error"])
-        processing_errors = len(results_df[results_df["Status"] == "Error"])
+        # Shares of the total for every status at once; empty (not a
+        # ZeroDivisionError) when there are no results
+        status_pcts = status_counts / total_files * 100
+        clean_files = int(status_counts.get("Clean", 0))
+        error_files = int(status_counts.get("Data Error", 0))
+        processing_errors = int(status_counts.get("Error", 0))
         
         with col1:
             st.metric("📁 Total Files", total_files)
         
         with col2:
-            st.metric("✅ Clean Files", clean_files, delta=f"{clean_files/total_files*100:.1f}%")
+            st.metric("✅ Clean Files", clean_files, delta=f"{status_pcts.get('Clean', 0):.1f}%")
         
         with col3:
-            st.metric("⚠️ Data Errors", error_files, delta=f"{error_files/total_files*100:.1f}%")
+            st.metric("⚠️ Data Errors", error_files, delta=f"{status_pcts.get('Data Error', 0):.1f}%")
         
         with col4:
-            st.metric("❌ Processing Errors", processing_errors, delta=f"{processing_errors/total_files*100:.1f}%")
+            st.metric("❌ Processing Errors", processing_errors, delta=f"{status_pcts.get('Error', 0):.1f}%")
         
         # Filter options
         st.markdown('<div class="section-header">🔍 Filter Results</div>', unsafe_allow_html=True)
@@ -401,12 +486,13 @@ def main():
         )
         
         # Filter dataframe
-        if filter_option == "Only Data Errors":
-            filtered_df = results_df[results_df["Status"] == "Data Error"]
-        elif filter_option == "Only Clean Files":
-            filtered_df = results_df[results_df["Status"] == "Clean"]
-        elif filter_option == "Only Processing Errors":
-            filtered_df = results_df[results_df["Status"] == "Error"]
+        status_filter = {
+            "Only Data Errors": "Data Error",
+            "Only Clean Files": "Clean",
+            "Only Processing Errors": "Error"
+        }.get(filter_option)
+        if status_filter:
+            filtered_df = results_df[results_df["Status"].eq(status_filter)]
         else:
             filtered_df = results_df
         
@@ -439,26 +525,25 @@ def main():
             timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
             full_report_filename = f"validation_report_{timestamp}.csv"
             
-            csv_full = results_df.to_csv(index=False)
             st.download_button(
                 label="📊 Download Full Report",
-                data=csv_full,
+                data=st.session_state.report_csv,
                 file_name=full_report_filename,
                 mime="text/csv",
+                on_click="ignore",
                 use_container_width=True
             )
         
         with col2:
             # Errors only report
-            errors_df = results_df[results_df["Status"].isin(["Data Error", "Error"])]
-            if len(errors_df) > 0:
+            if clean_files < total_files:
                 errors_filename = f"errors_only_{timestamp}.csv"
-                csv_errors = errors_df.to_csv(index=False)
                 st.download_button(
                     label="⚠️ Download Errors Only",
-                    data=csv_errors,
+                    data=st.session_state.errors_csv,
                     file_name=errors_filename,
                     mime="text/csv",
+                    on_click="ignore",
                     use_container_width=True
                 )
             else:
@@ -468,13 +553,16 @@ def main():
         if error_files > 0:
             st.markdown('<div class="section-header">🔍 Error Analysis</div>', unsafe_allow_html=True)
             
-            error_df = results_df[results_df["Status"] == "Data Error"]
+            error_df = results_df[results_df["Status"].eq("Data Error")]
             
+            # Streamlit renders expander contents even while collapsed, so
+            # send the whole list as one element instead of three per file
+            entries = (
+                "**" + error_df["PDF File"] + "** (Patient ID: " + error_df["Patient ID"].astype(str) + ")\n\n"
+                + "└─ " + error_df["Data Errors"] + "\n\n---"
+            )
             with st.expander(f"View {len(error_df)} files with data errors"):
-                for _, row in error_df.iterrows():
-                    st.markdown(f"**{row['PDF File']}** (Patient ID: {row['Patient ID']})")
-                    st.markdown(f"└─ {row['Data Errors']}")
-                    st.markdown("---")
+                st.markdown(entries.str.cat(sep="\n\n"))
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,244 @@
+"""Everything that defines a GPT comparison request, shared by app.py and Raw.py.
+
+Both entry points must send byte-identical prompts: that keeps OpenAI's
+prompt cache warm and lets them share the on-disk response cache.
+"""
+import functools
+import hashlib
+import json
+import warnings
+import pandas as pd
+import tiktoken
+
+# Model used for all comparisons
+MODEL = "gpt-4o-mini"
+
+# Tokens of PDF text sent to GPT per PDF (about the 3800 characters the
+# original single-PDF prompt used)
+PDF_TOKENS_PER_CASE = 1000
+
+# Characters of PDF text sent instead when the tokenizer cannot be loaded
+PDF_CHARS_PER_CASE = 3800
+
+# Output tokens allowed per case in a response. A verdict listing a few
+# field mismatches needs well under this; the cap stops a runaway response
+# from holding up its whole request
+OUTPUT_TOKENS_PER_CASE = 200
+
+# Sent unchanged as the first message of every request so OpenAI can
+# serve it from its prompt cache
+SYSTEM_PROMPT = """
+You are a data verification assistant. Your ONLY job is to find ACTUAL DATA ERRORS.
+
+STRICT RULES:
+
+1. IGNORE these situations (DO NOT REPORT):
+   - Fields not found in PDF
+   - Date format differences (2024-12-01 00:00:00 = 1-Dec-2024 = 12/01/2024)
+   - Text format differences (BCBS = EXCEL BCBS = Finance Class BCBS)
+   - Case differences (JOHN = John = john)
+   - Extra spaces or punctuation
+   - Different field labels
+
+2. ONLY REPORT these situations:
+   - Completely different names (John Smith ≠ Jane Doe)
+   - Different insurance companies (BCBS ≠ Aetna) 
+   - Different calendar dates (Jan 1 ≠ Dec 31)
+   - Different amounts ($100 ≠ $200)
+
+EXAMPLES OF WHAT NOT TO REPORT:
+❌ "SWO Expiration Date: Excel has '2024-12-01 00:00:00', PDF has '1-Dec-2024'" = SAME DATE
+❌ "Field 'Last usage Date' not found in PDF" = IRRELEVANT
+❌ "Insurance: Excel has 'BCBS', PDF has 'Finance Class BCBS'" = SAME COMPANY
+
+EXAMPLES OF WHAT TO REPORT:
+✅ "Patient Name: Excel has 'JOHN SMITH', PDF has 'JANE DOE'" = DIFFERENT PERSON
+✅ "Insurance: Excel has 'BCBS', PDF has 'AETNA'" = DIFFERENT COMPANY
+
+INPUT FORMAT:
+You receive several cases. Each starts with "---CASE <id>---" and holds the
+PDF text and the Excel data for one patient. Check every case on its own.
+
+RESPONSE FORMAT:
+Return one result per case with:
+- case_id: the id from the case header
+- has_discrepancy: false if no actual data errors exist, true otherwise
+- description: empty if has_discrepancy is false, otherwise
+  "Field Name: Excel has 'X', PDF has 'Y'" for each actual data error
+
+Be very strict - only report genuine data errors, not formatting or missing field issues.
+"""
+
+# Structured output: the API guarantees responses match this schema
+RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "verdicts",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "results": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "case_id": {"type": "string"},
+                            "has_discrepancy": {"type": "boolean"},
+                            "description": {"type": "string"}
+                        },
+                        "required": ["case_id", "has_discrepancy", "description"],
+                        "additionalProperties": False
+                    }
+                }
+            },
+            "required": ["results"],
+            "additionalProperties": False
+        }
+    }
+}
+
+# One case in the user message; static text first, variable content last
+CASE_TEMPLATE = "---CASE {case_id}---\nPDF Text:\n```\n{pdf}\n```\n\nExcel Data:\n```json\n{excel}\n```"
+
+# Identifies the request setup shared by every comparison; part of each cache key
+PROMPT_FINGERPRINT = hashlib.sha256(
+    (MODEL + SYSTEM_PROMPT + CASE_TEMPLATE + json.dumps(RESPONSE_FORMAT, sort_keys=True)).encode()
+).hexdigest()
+
+
+@functools.lru_cache(maxsize=None)
+def load_encoding():
+    """Tokenizer for MODEL, loaded once; a failed load raises and is not cached"""
+    return tiktoken.encoding_for_model(MODEL)
+
+def get_encoding():
+    """Tokenizer for MODEL, or None if it cannot be loaded right now.
+
+    tiktoken downloads the encoding on first use, which fails without
+    network access. Comparisons then fall back to a character slice, and
+    the next call tries the download again.
+    """
+    try:
+        return load_encoding()
+    except Exception as e:
+        warnings.warn(f"Could not load the {MODEL} tokenizer ({e}); truncating PDF text by characters")
+        return None
+
+def truncate_pdf_text(pdf_text):
+    """Cut PDF text to PDF_TOKENS_PER_CASE tokens of MODEL's tokenizer.
+
+    Slicing by tokens rather than characters fits more text from PDFs with
+    lots of whitespace or short words into the same token budget. Without
+    a tokenizer the text is cut to PDF_CHARS_PER_CASE characters instead.
+    """
+    enc = get_encoding()
+    if enc is None:
+        return pdf_text[:PDF_CHARS_PER_CASE]
+    return truncate_tokens(enc, pdf_text)
+
+@functools.lru_cache(maxsize=1024)
+def truncate_tokens(enc, pdf_text):
+    """Token truncation for truncate_pdf_text(), memoized per text"""
+    tokens = enc.encode(pdf_text, disallowed_special=())
+    if len(tokens) <= PDF_TOKENS_PER_CASE:
+        return pdf_text
+    return enc.decode(tokens[:PDF_TOKENS_PER_CASE])
+
+def cache_key(pdf_text, excel_row):
+    """Hash everything GPT sees for one comparison.
+
+    Covers the model, system prompt, case template and response schema as
+    well as the case itself, so editing the prompt invalidates earlier
+    cached verdicts.
+    """
+    payload = "|".join((
+        PROMPT_FINGERPRINT,
+        truncate_pdf_text(pdf_text),
+        compact_row(excel_row)
+    ))
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+def split_cached(cases, cache):
+    """Settle (case_id, pdf_text, excel_row) cases from the verdict cache.
+
+    Returns (hits, misses, copies): hits maps case_id to a cached verdict,
+    misses lists the cases GPT still has to compare, and copies maps the
+    case_id of a miss to the ids of identical cases (e.g. the same PDF
+    under two names) that reuse its verdict instead of being sent again.
+    """
+    hits = {}
+    misses = []
+    copies = {}
+    first_by_key = {}
+    for case_id, pdf_text, excel_row in cases:
+        key = cache_key(pdf_text, excel_row)
+        answer = cache.get(key)
+        if answer is not None:
+            hits[case_id] = answer
+        elif key in first_by_key:
+            copies.setdefault(first_by_key[key], []).append(case_id)
+        else:
+            first_by_key[key] = case_id
+            misses.append((case_id, pdf_text, excel_row))
+    return hits, misses, copies
+
+def compact_row(excel_row):
+    """Serialize an Excel row as compact JSON, leaving out empty cells.
+
+    Indentation and "NaN" placeholders only cost input tokens; GPT reads the
+    compact form just as well. The same row is serialized for its cache key
+    and its prompt, often for several PDFs, so results are memoized.
+    """
+    # Types are part of the key: 1, 1.0 and True are equal but serialize differently
+    return serialize_items(tuple((k, type(v), v) for k, v in excel_row.items() if not pd.isna(v)))
+
+@functools.lru_cache(maxsize=4096)
+def serialize_items(items):
+    """JSON for compact_row(), cached by the row's (field, type, value) items"""
+    return json.dumps(
+        {k: v for k, _, v in items},
+        separators=(",", ":"),
+        ensure_ascii=False,
+        default=str
+    )
+
+def build_messages(cases):
+    """Build the chat messages comparing (case_id, pdf_text, excel_row) cases"""
+    user = "\n\n".join(
+        CASE_TEMPLATE.format(
+            case_id=case_id,
+            pdf=truncate_pdf_text(pdf_text),
+            excel=compact_row(excel_row)
+        )
+        for case_id, pdf_text, excel_row in cases
+    )
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": user}
+    ]
+
+def max_output_tokens(cases):
+    """Completion token limit for a request comparing cases"""
+    return 50 + OUTPUT_TOKENS_PER_CASE * len(cases)
+
+def response_text(content, refusal=None, finish_reason=None):
+    """The JSON text of a structured-output response.
+
+    The schema is only guaranteed for completed answers, so refusals and
+    responses cut off at the token limit raise ValueError with the reason.
+    """
+    if refusal:
+        raise ValueError(f"model refused the request ({refusal})")
+    if finish_reason == "length":
+        raise ValueError("response cut off at the output token limit")
+    if not content:
+        raise ValueError("empty response")
+    return content
+
+def parse_verdicts(content):
+    """Map case_id -> verdict from a structured-output response"""
+    return {
+        item["case_id"]: item["description"].strip() if item["has_discrepancy"] else "No discrepancies"
+        for item in json.loads(content)["results"]
+    }
@@ -0,0 +1,46 @@
+import pytest
+
+import prompts
+
+
+class FakeEncoding:
+    """Whitespace tokenizer standing in for the downloaded tiktoken encoding"""
+
+    def encode(self, text, disallowed_special=()):
+        return text.split(" ")
+
+    def decode(self, tokens):
+        return " ".join(tokens)
+
+
+def test_failed_tokenizer_load_is_retried(monkeypatch):
+    calls = []
+
+    def encoding_for_model(model):
+        calls.append(model)
+        if len(calls) == 1:
+            raise ConnectionError("no network")
+        return FakeEncoding()
+
+    monkeypatch.setattr(prompts.tiktoken, "encoding_for_model", encoding_for_model)
+    prompts.load_encoding.cache_clear()
+    text = "word " * 3000
+
+    with pytest.warns(UserWarning, match="truncating PDF text by characters"):
+        assert prompts.truncate_pdf_text(text) == text[:prompts.PDF_CHARS_PER_CASE]
+    assert len(prompts.truncate_pdf_text(text).split(" ")) == prompts.PDF_TOKENS_PER_CASE
+    assert len(calls) == 2
+    prompts.load_encoding.cache_clear()
+
+
+def test_split_cached_sends_identical_cases_once(monkeypatch):
+    monkeypatch.setattr(prompts, "truncate_pdf_text", lambda pdf_text: pdf_text)
+    row = {"Amount": 100}
+    cache = {prompts.cache_key("cached", row): "No discrepancies"}
+    cases = [("a.pdf", "cached", row), ("b.pdf", "new", row), ("c.pdf", "new", row), ("d.pdf", "other", row)]
+
+    hits, misses, copies = prompts.split_cached(cases, cache)
+
+    assert hits == {"a.pdf": "No discrepancies"}
+    assert [case_id for case_id, _, _ in misses] == ["b.pdf", "d.pdf"]
+    assert copies == {"b.pdf": ["c.pdf"]}
@@ -0,0 +1,112 @@
+import json
+import types
+
+import diskcache
+import fitz
+import pandas as pd
+import pytest
+
+import Raw
+
+
+class FakeOpenAI:
+    """Records the batch requests Raw.py submits and answers them with no discrepancies"""
+
+    def __init__(self, *args, **kwargs):
+        self.requests = []
+        self.files = types.SimpleNamespace(create=self.create_file, content=self.file_content)
+        self.batches = types.SimpleNamespace(create=self.create_batch, retrieve=self.retrieve_batch)
+
+    def create_file(self, file, purpose):
+        self.requests = [json.loads(line) for line in file.read().decode().splitlines()]
+        return types.SimpleNamespace(id="input")
+
+    def create_batch(self, **kwargs):
+        return types.SimpleNamespace(id="batch")
+
+    def retrieve_batch(self, batch_id):
+        return types.SimpleNamespace(id=batch_id, status="completed", output_file_id="output", error_file_id=None)
+
+    def file_content(self, file_id):
+        lines = []
+        for request in self.requests:
+            user = request["body"]["messages"][1]["content"]
+            case_ids = [part.split("---", 1)[0] for part in user.split("---CASE ")[1:]]
+            content = json.dumps({"results": [
+                {"case_id": case_id, "has_discrepancy": False, "description": ""} for case_id in case_ids
+            ]})
+            lines.append(json.dumps({"custom_id": request["custom_id"], "response": {
+                "status_code": 200,
+                "body": {"choices": [{"message": {"content": content}, "finish_reason": "stop"}]},
+            }}))
+        return types.SimpleNamespace(text="\n".join(lines))
+
+
+@pytest.fixture
+def raw_env(tmp_path, monkeypatch):
+    """Point Raw.py at one PDF and one Excel row in tmp_path, with empty caches"""
+    def setup(pdf_text, excel_row):
+        pdf_dir = tmp_path / "pdfs"
+        pdf_dir.mkdir()
+        with fitz.open() as doc:
+            doc.new_page().insert_text((72, 72), pdf_text)
+            doc.save(pdf_dir / "invoice.pdf")
+        pd.DataFrame([excel_row]).to_excel(tmp_path / "master.xlsx", index=False)
+
+        monkeypatch.setattr(Raw, "EXCEL_FILE", str(tmp_path / "master.xlsx"))
+        monkeypatch.setattr(Raw, "PDF_FOLDER", str(pdf_dir))
+        monkeypatch.setattr(Raw, "OUTPUT_FILE", str(tmp_path / "report.csv"))
+        monkeypatch.setattr(Raw, "cache", diskcache.Cache(str(tmp_path / "gpt_cache")))
+        monkeypatch.setattr(Raw, "pdf_cache", diskcache.Cache(str(tmp_path / "pdf_cache")))
+        client = FakeOpenAI()
+        monkeypatch.setattr(Raw, "OpenAI", lambda *args, **kwargs: client)
+        return client
+    return setup
+
+
+def sent_excel_data(client):
+    """The Excel JSON of the single case in the single batch request"""
+    assert len(client.requests) == 1, "the comparison should have been sent to GPT"
+    user = client.requests[0]["body"]["messages"][1]["content"]
+    return json.loads(user.split("```json\n", 1)[1].split("\n```", 1)[0])
+
+
+def test_amount_mismatch_reaches_gpt_with_the_whole_row(raw_env):
+    client = raw_env(
+        "Patient ID: 1001\nPatient Name: JOHN SMITH\nAmount: $100.50\nCnt: 1",
+        {"Patient ID": "1001", "Patient Name": "JOHN SMITH", "Amount": 100, "Cnt": 1},
+    )
+    Raw.main()
+    sent = sent_excel_data(client)
+    assert sent["Amount"] == 100
+    assert sent["Patient Name"] == "JOHN SMITH"
+
+
+def test_date_found_elsewhere_in_pdf_still_reaches_gpt(raw_env):
+    client = raw_env(
+        "Patient ID: 1001\nPatient Name: JANE DOE\nDate of Birth: 12/01/2024\nSWO Expiration Date: 1-Jan-2025",
+        {"Patient ID": "1001", "Patient Name": "JOHN SMITH", "SWO Expiration Date": "2024-12-01"},
+    )
+    Raw.main()
+    assert sent_excel_data(client)["SWO Expiration Date"] == "2024-12-01"
+
+
+class BatchNotFound(Raw.NotFoundError):
+    """404 from batches.retrieve, without the HTTP response the SDK would attach"""
+
+    def __init__(self, batch_id):
+        Exception.__init__(self, f"No batch found with id '{batch_id}'")
+        self.status_code = 404
+        self.body = None
+
+
+def test_batch_unknown_to_the_api_is_not_resumed_again(raw_env):
+    client = raw_env("Patient ID: 1001\nAmount: $100.50", {"Patient ID": "1001", "Amount": 100})
+
+    def retrieve_batch(batch_id):
+        raise BatchNotFound(batch_id)
+    client.batches.retrieve = retrieve_batch
+
+    with pytest.raises(Raw.NotFoundError):
+        Raw.main()
+    assert not [key for key in Raw.cache.iterkeys() if str(key).startswith("batch:")]
@@ -0,0 +1,39 @@
+import pandas as pd
+import pytest
+
+from utils import all_values_found
+
+
+@pytest.mark.parametrize("value, pdf_text", [
+    (100, "Amount: $100.50"),
+    (234, "Amount: $1,234.00"),
+    (100, "Adjustment: -100"),
+    (2024, "SWO Expiration Date: 12/01/2024"),
+    (100, "Units: 1/100"),
+])
+def test_number_inside_a_longer_number_is_unmatched(value, pdf_text):
+    assert not all_values_found(pdf_text, {"Amount": value})
+
+
+@pytest.mark.parametrize("value, pdf_text", [
+    (100, "Amount: $100"),
+    (100, "Amount: 100.00"),
+    (100, "Amount: 100."),
+    (1234, "Amount: $1,234.00"),
+    (1234.5, "Total 1,234.50 due"),
+    (-20, "Adjustment: -20"),
+    ("2024-12-01", "SWO Expiration Date: 12/01/2024."),
+    (pd.Timestamp("2024-12-01"), "Expires 1-Dec-2024"),
+])
+def test_number_and_date_spellings_match(value, pdf_text):
+    assert all_values_found(pdf_text, {"Field": value})
+
+
+def test_text_matches_regardless_of_case_and_spacing():
+    assert all_values_found("Patient Name: John   Smith, BCBS", {"Name": "JOHN SMITH", "Insurance": "bcbs"})
+
+
+@pytest.mark.parametrize("value", ["0000-00-00", "2024-02-30"])
+def test_invalid_iso_date_is_matched_as_text(value):
+    assert all_values_found(f"Expiration: {value}", {"Expiration": value})
+    assert not all_values_found("Expiration: none", {"Expiration": value})
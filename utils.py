@@ -0,0 +1,265 @@
+"""Helpers shared by the Streamlit app (app.py) and the batch script (Raw.py)"""
+import os
+import re
+import hashlib
+import functools
+import multiprocessing
+import numbers
+from datetime import date
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import fitz  # PyMuPDF
+import pandas as pd
+
+# "Patient ID: 123", "Patient ID - 123", "ID 123", ...
+PATIENT_ID_RE = re.compile(r"(?:Patient\s*ID|ID)\s*[:\-]?\s*(\d+)", re.IGNORECASE)
+
+WHITESPACE_RE = re.compile(r"\s+")
+ISO_DATE_RE = re.compile(r"\d{4}-\d{2}-\d{2}(?: 00:00:00)?")
+
+# Amount in a text cell: "1234.5", "1,234.50", "$1,234.50", "$ -20"
+MONEY_RE = re.compile(r"\$?\s*-?[\d,]*\d(?:\.\d+)?")
+
+# Date spellings accepted by all_values_found() (besides unpadded m/d/Y and d-Mon-Y)
+DATE_FORMATS = ("%Y-%m-%d", "%m/%d/%Y", "%m-%d-%Y", "%m/%d/%y", "%d-%b-%Y", "%d %b %Y", "%b %d, %Y", "%B %d, %Y")
+
+# Edges of a number or date spelling: no digit, separator or sign may continue it
+NUMBER_START = r"(?<![\w.,/-])"
+NUMBER_END = r"(?![\w]|[.,/-]\d)"
+
+# Shorter values ("M", "5") match almost any text, so they are left to GPT
+MIN_MATCH_LEN = 3
+
+# Text to extract per PDF; headroom over the ~1000 tokens sent to GPT, which
+# can span well over 4000 characters in whitespace-heavy PDFs
+MAX_PDF_CHARS = 12000
+
+# Read size when hashing PDF files on disk
+HASH_CHUNK_SIZE = 1 << 20
+
+# Plain-text extraction without image blocks, with ligatures ("ﬁ" -> "fi") and
+# odd whitespace normalized so regexes and string matching see plain characters
+TEXT_FLAGS = fitz.TEXTFLAGS_TEXT & ~(fitz.TEXT_PRESERVE_LIGATURES | fitz.TEXT_PRESERVE_WHITESPACE)
+
+def open_pdf(source):
+    """Open a PDF from a file path or PDF bytes"""
+    if isinstance(source, (bytes, bytearray)):
+        return fitz.open(stream=source, filetype="pdf")
+    return fitz.open(source)
+
+def find_patient_id(text):
+    """Extract Patient ID from PDF text"""
+    m = PATIENT_ID_RE.search(text)
+    return m.group(1) if m else None
+
+def read_pdf(source, max_chars=MAX_PDF_CHARS):
+    """Extract text and Patient ID from one PDF (runs in a worker process).
+
+    Pages are read only until max_chars of text are collected and the
+    Patient ID has been found; only the start of the text is sent to GPT.
+    """
+    parts, total, pid = [], 0, None
+    try:
+        with open_pdf(source) as doc:
+            for page in doc:
+                text = page.get_text("text", flags=TEXT_FLAGS, sort=False)
+                parts.append(text)
+                total += len(text)
+                if pid is None:
+                    pid = find_patient_id(text)
+                if pid and total >= max_chars:
+                    break
+    finally:
+        # MuPDF keeps fonts and images of closed documents in a process-wide
+        # store; empty it so a long-lived worker does not grow with every PDF
+        fitz.TOOLS.store_shrink(100)
+    return "\n".join(parts), pid
+
+def get_max_workers(n_tasks):
+    """One worker per CPU core, but never more workers than PDFs"""
+    return max(1, min(os.cpu_count() or 1, n_tasks))
+
+def read_pdfs(sources, on_complete=None):
+    """Read PDFs in parallel, one process per core (see get_max_workers).
+
+    Returns one (text, patient_id) tuple per source, in input order. A PDF
+    that fails to parse gets its exception in place of the tuple, so one bad
+    file does not abort the rest. PyMuPDF is not thread-safe, hence processes.
+    """
+    results = [None] * len(sources)
+    workers = get_max_workers(len(sources))
+    if workers <= 1:
+        # Not worth starting a process pool for a single PDF
+        for i, source in enumerate(sources):
+            try:
+                results[i] = read_pdf(source)
+            except Exception as e:
+                results[i] = e
+            if on_complete:
+                on_complete(i + 1, len(sources))
+        return results
+    
+    # "spawn" rather than Linux's default "fork": forking Streamlit's
+    # multi-threaded server can deadlock the child on a lock held by another thread
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        futures = {executor.submit(read_pdf, source): i for i, source in enumerate(sources)}
+        for done, future in enumerate(as_completed(futures), 1):
+            try:
+                results[futures[future]] = future.result()
+            except Exception as e:
+                results[futures[future]] = e
+            if on_complete:
+                on_complete(done, len(sources))
+    return results
+
+def pdf_key(source):
+    """Cache key for a PDF's extraction: SHA-1 of the file bytes plus the
+    extraction settings and Patient ID regex, so changing them invalidates
+    old entries.
+
+    Files on disk are hashed in HASH_CHUNK_SIZE pieces rather than read
+    whole; in-memory PDFs may be passed as a memoryview to avoid a copy.
+    """
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        digest = hashlib.sha1(source)
+    else:
+        digest = hashlib.sha1()
+        with open(source, "rb") as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+                digest.update(chunk)
+    digest.update(f"|{MAX_PDF_CHARS}|{TEXT_FLAGS}|{PATIENT_ID_RE.pattern}|{PATIENT_ID_RE.flags}".encode())
+    return digest.hexdigest()
+
+def read_pdfs_cached(sources, cache, on_complete=None):
+    """read_pdfs() that skips PDFs already extracted in an earlier run.
+
+    Sources are file paths, bytes or memoryviews. Results are stored in
+    cache (a diskcache.Cache) by pdf_key(), so an unchanged file is never
+    parsed twice, whatever its name. Only the misses go to the process
+    pool; failures are not cached.
+    """
+    keys = [pdf_key(source) for source in sources]
+    results = [cache.get(key) for key in keys]
+    misses = [i for i, result in enumerate(results) if result is None]
+    hits = len(sources) - len(misses)
+    
+    def progress(done, total):
+        on_complete(hits + done, len(sources))
+    
+    # Worker processes need picklable bytes; only misses pay for the copy
+    to_read = [bytes(sources[i]) if isinstance(sources[i], memoryview) else sources[i] for i in misses]
+    extracted = read_pdfs(to_read, progress if on_complete else None)
+    for i, result in zip(misses, extracted):
+        results[i] = result
+        if not isinstance(result, Exception):
+            cache[keys[i]] = result
+    return results
+
+def load_master_data(source):
+    """Read the Excel master data from a path or file-like object.
+
+    Uses the Rust-based calamine reader, several times faster than openpyxl
+    on large sheets, when python-calamine is installed. Patient IDs are kept
+    as strings to match the PDF regex.
+    """
+    try:
+        df = pd.read_excel(source, dtype={"Patient ID": str}, engine="calamine")
+    except ImportError:
+        # pandas picks openpyxl for .xlsx (xlrd for legacy .xls)
+        df = pd.read_excel(source, dtype={"Patient ID": str})
+    return normalize_master_data(df)
+
+def normalize_master_data(df):
+    """Canonicalize value types once at load time.
+
+    Date-only columns become ISO "YYYY-MM-DD" strings instead of
+    "2024-12-01 00:00:00", currency text such as "$1,234.50" becomes
+    numbers, and float columns holding whole numbers become nullable
+    integers so 100 is not rendered as "100.0". Both shorten the
+    prompt and remove false positives GPT would otherwise have to ignore.
+    """
+    for col in df.columns:
+        if pd.api.types.is_object_dtype(df[col]) or pd.api.types.is_string_dtype(df[col]):
+            amounts = parse_money(df[col])
+            if amounts is not None:
+                df[col] = amounts
+        values = df[col].dropna()
+        if pd.api.types.is_datetime64_any_dtype(df[col]):
+            if (values == values.dt.normalize()).all():
+                df[col] = df[col].dt.strftime("%Y-%m-%d")
+        elif pd.api.types.is_float_dtype(df[col]):
+            if (values % 1 == 0).all():
+                df[col] = df[col].astype("Int64")
+    return df
+
+def index_by_patient_id(df):
+    """Map each Patient ID to its Excel row; the first record per ID wins"""
+    return (
+        df.drop_duplicates("Patient ID")
+          .set_index("Patient ID", drop=False)
+          .to_dict(orient="index")
+    )
+
+def parse_money(series):
+    """Parse a text column of amounts like "$1,234.50" into floats, vectorized.
+
+    Returns None unless every non-empty value is an amount and at least one
+    carries a "$", so IDs, ZIP codes and phone numbers stay text.
+    """
+    text = series.dropna().astype(str).str.strip()
+    if text.empty or not text.str.startswith("$").any() or not text.str.fullmatch(MONEY_RE).all():
+        return None
+    return pd.to_numeric(series.astype(str).str.replace(r"[$,\s]", "", regex=True), errors="coerce")
+
+def value_variants(value):
+    """Lowercased spellings of an Excel value that count as a match in PDF text"""
+    if isinstance(value, str) and ISO_DATE_RE.fullmatch(value.strip()):
+        try:
+            value = pd.Timestamp(value.strip())
+        except ValueError:
+            # Placeholders like "0000-00-00" or impossible dates: match as text
+            pass
+    if isinstance(value, date):
+        variants = {value.strftime(fmt) for fmt in DATE_FORMATS}
+        variants.add(f"{value.month}/{value.day}/{value.year}")
+        variants.add(f"{value.day}-{value.strftime('%b')}-{value.year}")
+        return {v.lower() for v in variants}
+    if isinstance(value, numbers.Real) and not isinstance(value, bool):
+        if float(value).is_integer():
+            n = int(value)
+            return {str(n), f"{n:,}", f"{n}.00", f"{n:,}.00"}
+        return {str(value), f"{value:.2f}", f"{value:,.2f}"}
+    return {WHITESPACE_RE.sub(" ", str(value).strip().lower())}
+
+@functools.lru_cache(maxsize=4096, typed=True)
+def value_pattern(value):
+    """One compiled regex matching any spelling of value as a whole word.
+
+    Returns None when no spelling is long enough to match reliably. Master
+    data values recur across PDFs and runs, so patterns are compiled once.
+    """
+    variants = sorted((v for v in value_variants(value) if len(v) >= MIN_MATCH_LEN), key=len, reverse=True)
+    if not variants:
+        return None
+    return re.compile("|".join(map(spelling_pattern, variants)))
+
+def spelling_pattern(spelling):
+    """Regex for one spelling as a whole word; numbers and dates must not be
+    part of a longer number ("100" in "$100.50", "1,100", "-100", "1/100")"""
+    before = NUMBER_START if spelling[0].isdigit() or spelling[0] == "-" else r"(?<!\w)"
+    after = NUMBER_END if spelling[-1].isdigit() else r"(?!\w)"
+    return before + re.escape(spelling) + after
+
+def all_values_found(pdf_text, excel_row):
+    """Check without GPT that every Excel value appears in the PDF text.
+
+    Returns False as soon as one non-empty value is missing or too short to
+    match reliably, in which case the whole row still has to go to GPT.
+    """
+    pdf_norm = WHITESPACE_RE.sub(" ", pdf_text.lower())
+    for value in excel_row.values():
+        if pd.isna(value) or (isinstance(value, str) and not value.strip()):
+            continue
+        pattern = value_pattern(value)
+        if pattern is None or not pattern.search(pdf_norm):
+            return False
+    return True